@@ -0,0 +1,59 @@
+# Copyright (c) 2015 Brad Neuman
+
+# On-disk cache of parsed git blame results. Which commit each line comes from never changes for a given
+# commit, filename and set of options, so anything stored here can be reused by later runs instead of calling
+# git again. Author names are not stored, since git blame maps them through the current .mailmap
+
+import pickle
+import hashlib
+import os
+import sqlite3
+
+class BlameCache:
+    "sqlite-backed map of (repository, rev, filename, options) -> dict of sha -> num_lines. rev should be a"
+    " full sha, not a branch name, otherwise the cached result can go stale"
+
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+
+        # the cache is written after every commit. Losing the last few entries in a crash only costs a re-blame,
+        # so don't wait for a full sync each time
+        self.conn.execute('pragma journal_mode=wal')
+        self.conn.execute('pragma synchronous=normal')
+
+        with self.conn:
+            # older versions stored author names, which went stale when .mailmap changed
+            self.conn.execute('drop table if exists blame_cache')
+            self.conn.execute('''
+            create table if not exists blame_shas (
+                   key text primary key,
+                   blame blob not null
+            );
+            ''')
+
+    def MakeKey(self, repository, rev, filename, options):
+        "return the string used to look up an entry. Hashed so that non-ascii filenames are fine"
+        parts = [os.path.abspath(repository), rev, filename, options]
+        return hashlib.sha1('\0'.join(parts).encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def Get(self, repository, rev, filename, options):
+        "return the cached dict of sha -> num_lines, or None if there isn't one"
+
+        sql = 'select blame from blame_shas where key = (?)'
+        row = self.conn.execute(sql, (self.MakeKey(repository, rev, filename, options),)).fetchone()
+        if row is None:
+            return None
+
+        return pickle.loads(row[0])
+
+    def PutMany(self, entries):
+        "store a list of (repository, rev, filename, options, sha -> num_lines) tuples in one transaction"
+
+        rows = [ (self.MakeKey(repository, rev, filename, options), sqlite3.Binary(pickle.dumps(blame, pickle.HIGHEST_PROTOCOL)))
+                 for repository, rev, filename, options, blame in entries ]
+
+        with self.conn:
+            self.conn.executemany('insert or replace into blame_shas values (?, ?)', rows)
+
+    def Close(self):
+        self.conn.close()
@@ -2,6 +2,8 @@
 
 # Common place to put useful re-usable queries into the blame database
 
+from collections import defaultdict
+
 def GetCurrentBlame(cursor):
     "return a list of tuples of (filename, author, num_lines) that represents"
     "the current count of lines from git blame, excluding merges"
@@ -30,20 +32,16 @@ def GetBlameOverTime(cursor):
 
     # build up the cumulative sum as we go
     ret = []
-    currLines = {}
+    currLines = defaultdict(int)
 
     for row in cursor.execute(sql):
         sha = row[0]
         author = row[1]
         lineDelta = row[2]
 
-        lastLines = 0
-        if author in currLines:
-            lastLines = currLines[author]
-        newLines = lastLines + lineDelta
+        currLines[author] += lineDelta
 
-        ret.append( (sha, author, newLines) )
-        currLines[author] = newLines
+        ret.append( (sha, author, currLines[author]) )
 
     return ret
 
@@ -68,8 +66,13 @@ def GetAllAuthors(cursor, nameMap = []):
     return list(nameSet)
 
 def GetFullBlameOverTime(cursor, exclusions = [], nameMap = {}):
-    "return the whole damn thing. TODO: dont use fetchall, write it out bit by bit"
-    "list of (timestamp, repo, sha1, { author: num_lines} )"
+    "return the whole damn thing, as a list of (timestamp, repo, sha1, { author: num_lines} )"
+
+    return list(IterFullBlameOverTime(cursor, exclusions, nameMap))
+
+def IterFullBlameOverTime(cursor, exclusions = [], nameMap = {}):
+    "same as GetFullBlameOverTime, but yields one (timestamp, repo, sha1, { author: num_lines} ) at a time, so"
+    "the caller can write each one out without keeping a dict of every author for every commit in memory"
 
     # go through each repository in the database, and get the blame log for each one
 
@@ -81,7 +84,10 @@ def GetFullBlameOverTime(cursor, exclusions = [], nameMap = {}):
     for row in data:
         repos[row[0]] = {}
 
-    # print repos
+    # author name from the database -> name after applying nameMap
+    names = {}
+
+    # print(repos)
 
     for repo in repos:
 
@@ -102,29 +108,33 @@ def GetFullBlameOverTime(cursor, exclusions = [], nameMap = {}):
 
         tpl = tuple([repo] + exclusions)
 
-        print "querying for '%s'..." % repo
+        print(f"querying for '{repo}'...")
 
         for row in cursor.execute(sql, tpl):
             ts = row[0]
             sha = row[2]
             topoOrder = row[3]
-            author = GetName(nameMap, row[4])
             numLines = row[5]
 
+            # sqlite returns a new string for every row, so map each name once and share the result
+            author = names.get(row[4])
+            if author is None:
+                author = GetName(nameMap, row[4])
+                names[row[4]] = author
+
             if topoOrder not in repos[repo]:
                 repos[repo][topoOrder] = (ts, sha, {})
             repos[repo][topoOrder][2][author] = numLines
 
-        # print "got %d commits from '%s'" % (len(repos[repo]), repo)
+        # print(f"got {len(repos[repo])} commits from '{repo}'")
 
 
     # now merge the lists. Keep the topographic order whithin each list, but merge based on timestamp
-    ret = []
     repoIdx = {}
     for repo in repos:
-        repoIdx[repo] = min(repos[repo].keys())
+        repoIdx[repo] = min(repos[repo])
 
-    print "merging."
+    print("merging.")
 
     # we want each commit entry to have a sum of the work for each author across all repositories. E.g. if the
     # commit is from repo B, we want to show the number of lines for the author as everything already done in
@@ -138,7 +148,7 @@ def GetFullBlameOverTime(cursor, exclusions = [], nameMap = {}):
 
     # will remove the repo when we hit the end
     while repoIdx:
-        # print repoIdx
+        # print(repoIdx)
 
         min_times = []
         for repo in repoIdx:
@@ -162,24 +172,19 @@ def GetFullBlameOverTime(cursor, exclusions = [], nameMap = {}):
             currentWork[repo][author] = commitWork[author]
 
         # now create the return data by summing up the current work
-        sumWork = {}
+        sumWork = defaultdict(int)
         for sumRepo in currentWork:
             for author in currentWork[sumRepo]:
-                ac = 0
-                if author in sumWork:
-                    ac = sumWork[author]
-                sumWork[author] = ac + currentWork[sumRepo][author]
+                sumWork[author] += currentWork[sumRepo][author]
 
-        ret.append( (ts, repo, sha, sumWork) )
+        yield (ts, repo, sha, sumWork)
 
         # increment index, and delete it if its not there anymore
         repoIdx[repo] += 1
         if repoIdx[repo] not in repos[repo]:
-            # print "finished merging %s" % repo
+            # print(f"finished merging {repo}")
             del repoIdx[repo]
 
-    return ret
-
 def GetLatestRevision(cursor, repository):
     "return a tuple of (sha, topo_order) for the latest entry in commits for the given repo"
     "return None if there are no entreis for the repo"
@@ -200,35 +205,33 @@ def GetLatestFullBlames(cursor, repository):
     sql = 'select filename, author, lines from full_blames where sha = (?)'
 
     stats = {}
+    # author -> the one string object used for that author, so every file shares it
+    authors = {}
     for row in cursor.execute(sql, (lastRev,)):
         filename = row[0]
-        author = row[1]
+        author = authors.setdefault(row[1], row[1])
         lines = row[2]
         if author == '':
             continue
-        if filename not in stats:
-            stats[filename] = {}
-        stats[filename][author] = lines
+        stats.setdefault(filename, {})[author] = lines
 
     return stats
 
 def PrintDiffSpikes(cursor, exclusions = [], nameMap = {}, num = 10):
     "Looks over the full blame and returns large spikes which could be due to files that might want to be exluded"
 
-    blames = GetFullBlameOverTime( cursor, exclusions, nameMap )
+    blames = IterFullBlameOverTime( cursor, exclusions, nameMap )
 
     # first sort by author
 
     # map of author -> list of (repo, sha1, num_lines)
-    blamesByAuthor = {}
+    blamesByAuthor = defaultdict(list)
 
     for line in blames:
         repo = line[1]
         sha = line[2]
         authorLines = line[3]
         for author in authorLines:
-            if author not in blamesByAuthor:
-                blamesByAuthor[author] = []
             blamesByAuthor[author].append( (repo, sha, authorLines[author]) )
 
 
@@ -243,13 +246,13 @@ def PrintDiffSpikes(cursor, exclusions = [], nameMap = {}, num = 10):
             last = blame[2]
             diffs.append( (author, diff, blame[0], blame[1]) )
 
-    print "computed %d diffs" % len(diffs)
+    print(f"computed {len(diffs)} diffs")
 
-    diffs.sort( lambda lhs, rhs : -1 if lhs[1] > rhs[1] else 1 )
+    diffs.sort(key=lambda d: d[1], reverse=True)
 
-    print "top %d diff spikes:" % num
+    print(f"top {num} diff spikes:")
     for d in diffs[:num]:
-        print d
+        print(d)
 
 def PrintLargeFiles(cursor, exclusions = [], num = 10):
     "looks for files that may be causing large spikes in the diff lines"
@@ -262,12 +265,12 @@ def PrintLargeFiles(cursor, exclusions = [], num = 10):
     for i in range(len(exclusions)):
         sql = sql + " and filename not like (?) "
 
-    sql += '''
+    sql += f'''
     group by filename, repository
     order by max_lines DESC
-    limit %d''' % num
+    limit {int(num)}'''
 
-    print "querying for %d largest files..." % num
+    print(f"querying for {num} largest files...")
 
     tpl = tuple(exclusions)
     for row in cursor.execute(sql, tpl):
@@ -275,7 +278,7 @@ def PrintLargeFiles(cursor, exclusions = [], num = 10):
         repo = row[1]
         lines = row[2]
 
-        print "%s (from %s): %d" % (filename, repo, lines)
+        print(f"{filename} (from {repo}): {lines}")
 
 
 
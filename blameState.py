@@ -0,0 +1,132 @@
+# Copyright (c) 2015 Brad Neuman
+
+# Keeps the blame of every file in memory, as the author of each line, and updates it from the diff of each
+# commit. This gives the same answer as running git blame after every commit without ever running it, but
+# only for histories with no merges, and without git blame's copy and move detection inside files
+
+from collections import defaultdict
+import pickle
+import os
+import sqlite3
+
+class BlameState:
+    "filename -> list of author indices, one per line of the file. Authors are stored as small ints into"
+    " self.authors so that each line costs a pointer to a shared int instead of a string"
+
+    def __init__(self):
+        self.files = {}
+
+        # index -> author name, and the reverse
+        self.authors = []
+        self.authorIdx = {}
+
+    def GetAuthorIndex(self, author):
+        "return the index for author, adding it if it's new"
+        if author not in self.authorIdx:
+            self.authorIdx[author] = len(self.authors)
+            self.authors.append(author)
+        return self.authorIdx[author]
+
+    def ApplyDiff(self, author, fileDiffs):
+        "update the state with one commit by author. fileDiffs is the list from BlameStats.GetDiffHunks."
+        " Returns a dictionary of old filename -> list of (author, lines lost), like GetOldBlameStats"
+
+        authorIdx = self.GetAuthorIndex(author)
+
+        # grab the starting lines of every file before changing anything, since a commit can rename a file
+        # and then add a new one with the old name, or copy a file that it also edits
+        sources = []
+        for oldFile, newFile, isCopy, hunks in fileDiffs:
+            if oldFile is None:
+                lines = []
+            elif isCopy:
+                lines = list(self.files.get(oldFile, []))
+            else:
+                lines = self.files.get(oldFile, [])
+            sources.append(lines)
+
+        # files that are gone under their old name (deleted or renamed)
+        for oldFile, newFile, isCopy, hunks in fileDiffs:
+            if oldFile is not None and not isCopy and oldFile != newFile:
+                self.files.pop(oldFile, None)
+
+        linesLost = {}
+
+        for (oldFile, newFile, isCopy, hunks), lines in zip(fileDiffs, sources):
+            lostPerAuthor = defaultdict(int)
+
+            # go backwards so that the earlier line numbers are still right after changing the later ones
+            for oldStart, oldNum, newNum in reversed(hunks):
+                # with nothing removed, oldStart is the line the new lines go after
+                start = oldStart - 1 if oldNum else oldStart
+                for lineAuthor in lines[start:start+oldNum]:
+                    lostPerAuthor[lineAuthor] += 1
+                lines[start:start+oldNum] = [authorIdx] * newNum
+
+            if lostPerAuthor:
+                linesLost[oldFile] = [ (self.authors[idx], lostPerAuthor[idx]) for idx in lostPerAuthor ]
+
+            if newFile is not None:
+                self.files[newFile] = lines
+
+        return linesLost
+
+    def GetBlames(self):
+        "return a dict of filename -> author -> num_lines, like BlameStats.GetFullBlames"
+
+        ret = {}
+        for filename in self.files:
+            lines = self.files[filename]
+            if not lines:
+                continue
+
+            counts = defaultdict(int)
+            for idx in lines:
+                counts[idx] += 1
+            ret[filename] = dict( (self.authors[idx], counts[idx]) for idx in counts )
+
+        return ret
+
+
+class BlameStateStore:
+    "sqlite-backed checkpoints of a BlameState after a given commit, so a later run can start from there and"
+    " only apply the new commits"
+
+    def __init__(self, filename):
+        self.conn = sqlite3.connect(filename)
+        with self.conn:
+            self.conn.execute('''
+            create table if not exists checkpoint (
+                   repository text not null,
+                   sha text not null,
+                   blame_state blob not null,
+                   primary key (repository, sha)
+            );
+            ''')
+
+    def Load(self, repository):
+        "return a tuple of (sha, BlameState) for the newest checkpoint of repository, or None if there isn't one"
+
+        sql = '''
+        select sha, blame_state from checkpoint
+        where repository = (?)
+        order by rowid desc limit 1
+        '''
+        row = self.conn.execute(sql, (os.path.abspath(repository),)).fetchone()
+        if row is None:
+            return None
+
+        return (row[0], pickle.loads(row[1], encoding='utf-8'))
+
+    def Save(self, repository, sha, state):
+        "store state as the blame of every file after commit sha. sha must be a full sha"
+
+        with self.conn:
+            # delete first so a re-saved sha becomes the newest row again
+            self.conn.execute('delete from checkpoint where repository = (?) and sha = (?)',
+                              (os.path.abspath(repository), sha))
+            self.conn.execute('insert into checkpoint values (?, ?, ?)',
+                              (os.path.abspath(repository), sha, sqlite3.Binary(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))))
+
+    def Close(self):
+        self.conn.close()
@@ -12,10 +12,10 @@ parser.add_argument('-n', default=10, type=int, help='number of entries to print
 args = parser.parse_args()
 
 if not os.path.exists(args.database):
-    print "database file does not exit!"
+    print("database file does not exit!")
     parser.print_help()
 elif not os.path.exists(args.exclusions):
-    print "exclusions file does not exit!"
+    print("exclusions file does not exit!")
     parser.print_help()
 else:
 
@@ -2,22 +2,281 @@
 
 # This file holds the code that interacts with git, without any other dependencies
 
-import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pprint import pprint
+import os
+import re
+import subprocess
+
+# prefixes of the lines the diff and blame parsers look for
+_DIFF = 'diff'
+_HUNK = '@@'
+_MERGE_HUNK = '@@@'
+_OLD_FILE = '---'
+_NEW_FILE = '+++'
+_OLD_NULL = '--- /dev/null'
+_NEW_NULL = '+++ /dev/null'
+_RENAME_FROM = 'rename from '
+_RENAME_TO = 'rename to '
+_COPY_FROM = 'copy from '
+_COPY_TO = 'copy to '
+_FILENAME = 'filename '
+
+# "@@ -start[,count] +start[,count] @@". A count of 1 isn't printed
+_HUNK_RE = re.compile(r'@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+# a backslash escape inside a quoted filename: three octal digits for one byte, or a single character
+_ESCAPE_RE = re.compile(rb'\\([0-7]{3}|.)')
+_C_ESCAPES = {b'a': b'\a', b'b': b'\b', b't': b'\t', b'n': b'\n', b'v': b'\v', b'f': b'\f', b'r': b'\r'}
+
+def _Text(data):
+    "git prints bytes. Decode them as utf-8, keeping any invalid bytes as surrogates so that filenames still"
+    " come out the same when passed back to git"
+    return data.decode('utf-8', 'surrogateescape')
+
+def _GitLines(cmd):
+    "run cmd and yield each line of its output (without the newline) as it is produced, rather than"
+    " buffering all of it. Raises subprocess.CalledProcessError at the end if the command failed"
+
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1<<20)
+    finished = False
+    try:
+        for line in proc.stdout:
+            line = _Text(line)
+            if line[-1:] == '\n':
+                line = line[:-1]
+            yield line
+        finished = True
+    finally:
+        # if the caller stopped early, don't wait for git to write output nobody will read
+        if not finished:
+            proc.kill()
+        proc.stdout.close()
+        retcode = proc.wait()
+
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, cmd)
+
+
+def _Unescape(match):
+    "helper for _DiffPath, returns the byte for one escape"
+    escape = match.group(1)
+    if len(escape) == 3:
+        return bytes([int(escape, 8)])
+    return _C_ESCAPES.get(escape, escape)
+
+def _DiffPath(path):
+    "given a filename as git prints it in a diff header, return the real filename. git adds a tab after names"
+    " with spaces in them, and puts names with unusual characters in double quotes with C-style escapes"
+    if path[-1:] == '\t':
+        path = path[:-1]
+    if path[:1] == '"' and path[-1:] == '"':
+        # the escapes are for bytes, not characters, so undo them on the encoded name
+        path = _Text(_ESCAPE_RE.sub(_Unescape, path[1:-1].encode('utf-8', 'surrogateescape')))
+    return path
+
+
+def _EchoLines(lines):
+    "yield each of lines after printing it, for debugging"
+    for line in lines:
+        print(line)
+        yield line
+
+
+def _CoalesceRanges(ranges):
+    "given a list of (startLine, numLines), return them sorted with overlapping or adjacent ranges merged,"
+    " so git blame has fewer -L ranges to walk"
+
+    ret = []
+    for startLine, numLines in sorted(ranges):
+        if ret and ret[-1][0] + ret[-1][1] >= startLine:
+            lastStart, lastNum = ret[-1]
+            ret[-1] = (lastStart, max(lastNum, startLine + numLines - lastStart))
+        else:
+            ret.append( (startLine, numLines) )
+
+    return ret
+
+
+class _GitWorker:
+    "A long-running 'git cat-file --batch' process. Objects are requested by writing their name to stdin, so"
+    " reading many commits costs one process spawn in total instead of one per commit"
+
+    def __init__(self, git_cmd):
+        self.git_cmd = git_cmd
+
+        cmd = git_cmd + ['cat-file',
+                         '--batch' # print info and contents for each object named on stdin
+                        ]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=-1)
+
+        # "Name <email>" -> mapped author name, so .mailmap is only consulted once per author
+        self.mailmap = {}
+
+    def GetObject(self, rev):
+        "return a tuple of (sha, type, contents) for the object named by rev, or None if it doesn't exist"
+
+        self.proc.stdin.write((rev + '\n').encode('utf-8', 'surrogateescape'))
+        self.proc.stdin.flush()
+
+        # header is either "<sha> <type> <size>" or "<rev> missing"
+        header = _Text(self.proc.stdout.readline()).split()
+        if len(header) != 3:
+            return None
+
+        # the size is in bytes, so read before decoding
+        contents = self.proc.stdout.read(int(header[2]))
+        self.proc.stdout.read(1) # trailing newline after the contents
+        return (header[0], header[1], _Text(contents))
+
+    def GetSha(self, rev):
+        "return the full sha of the commit named by rev"
+
+        obj = self.GetObject(rev + '^{commit}')
+        if obj is None:
+            raise ValueError(f"'{rev}' is not a valid commit")
+        return obj[0]
+
+    def GetCommit(self, rev):
+        "return a tuple of (list of parents, author timestamp, author name) for the commit named by rev"
+
+        obj = self.GetObject(rev + '^{commit}')
+        if obj is None:
+            raise ValueError(f"'{rev}' is not a valid commit")
+
+        parents = []
+        ts = 0
+        author = ''
+
+        # only the header matters, which ends at the first blank line
+        for line in obj[2].split('\n'):
+            if line == '':
+                break
+            if line[:7] == 'parent ':
+                parents.append(line[7:])
+            elif line[:7] == 'author ':
+                # author Name <email> timestamp timezone
+                gtIdx = line.rfind('>')
+                author = self.MapAuthor(line[7:gtIdx+1])
+                ts = int(line[gtIdx+2:].split(' ')[0])
+
+        return (parents, ts, author)
+
+    def MapAuthor(self, contact):
+        "given 'Name <email>', return the author name after applying .mailmap (the same as %aN in git log)"
+
+        if contact not in self.mailmap:
+            mapped = _Text(subprocess.check_output(self.git_cmd + ['check-mailmap', contact]))
+            self.mailmap[contact] = mapped[:mapped.rfind(' <')]
+
+        return self.mailmap[contact]
+
+    def Close(self):
+        "shut down the git process"
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+class _GitDiffWorker:
+    "A long-running 'git diff-tree --stdin' process, so diffing each commit doesn't cost a process spawn. After"
+    " each request a blank line is written, which git echoes back (and flushes) once the diff is done"
+
+    def __init__(self, git_cmd):
+        # without quotePath git quotes every non-ascii filename. Names with quotes, backslashes or control
+        # characters still get quoted, see _DiffPath
+        cmd = git_cmd + ['-c', 'core.quotePath=false',
+                         'diff-tree',
+                         '--stdin', # read the commits to diff from stdin
+                         '-r', # recurse into directories
+                         '-p', # print the patch, not just the filenames
+                         '-C', # find copies
+                         '-M', # find moves
+                         '-U0', # don't print extra lines around diff
+                         '-w', # ignore whitespace
+                         '--root', # show the root commit as adding everything
+                         '--ignore-submodules',
+                         '--no-commit-id',
+                         '--no-color'
+                        ]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=-1)
+
+    def GetDiffLines(self, rev, lastRev = None):
+        "yield the lines (without newlines) of the diff from lastRev to rev, or from the parent of rev if lastRev"
+        " is None, as git prints them. Merge commits have no parent to diff against, so yield nothing. Each"
+        " diff comes from the same process, so finish (or close) one before asking for the next. rev and lastRev"
+        " must be full shas, see BlameStats.GetDiffHunks"
+
+        if lastRev:
+            self.proc.stdin.write(f'{rev} {lastRev}\n\n'.encode())
+        else:
+            self.proc.stdin.write(f'{rev}\n\n'.encode())
+        self.proc.stdin.flush()
+
+        readline = self.proc.stdout.readline
+        finished = False
+        first = True
+        try:
+            while True:
+                line = readline()
+                if line == b'\n':
+                    finished = True
+                    return
+                if not line:
+                    # reap git, so the caller can tell from poll() that this worker is done
+                    self.proc.wait()
+                    raise ValueError(f"git diff-tree exited while diffing '{rev}'")
+                # git echoes back anything it can't read as a commit instead of diffing it
+                if first and line[:5] != b'diff ':
+                    raise ValueError(f"git diff-tree couldn't read '{_Text(line[:-1])}'")
+                first = False
+                yield _Text(line[:-1])
+        finally:
+            # if the caller stopped early, read the rest of this diff so the next one starts in the right place
+            while not finished:
+                line = readline()
+                finished = line == b'\n' or not line
+
+    def Close(self):
+        "shut down the git process"
+        self.proc.stdin.close()
+        self.proc.wait()
+
 
 class BlameStats:
     "Interface to git to collect statistics about blame lines for a given repository. The main function"
     " is GetCommitStats()"
 
-    def __init__(self, repo_path, debug = False):
+    def __init__(self, repo_path, debug = False, cache = None, num_threads = None):
         self.repo = repo_path
         self.debug = debug
         self.git_cmd = ['git', '-C', self.repo, '--no-pager']
 
+        # optional BlameCache to avoid re-running blame on things we've already seen
+        self.cache = cache
+
+        # started on first use, see GetGitWorker() and GetDiffWorker()
+        self.worker = None
+        self.diffWorker = None
+
+        # rev -> (list of parents, timestamp, author), filled in by GetAllCommits and GetCommit
+        self.commits = {}
+
+        # how many git blames to run at once. Each one is single threaded, and we mostly just wait on them
+        if num_threads is None:
+            num_threads = min(8, os.cpu_count() or 1)
+        self.num_threads = num_threads
+
+        # started on first use, see GetThreadPool()
+        self.pool = None
+
+        # author name -> the one string object used for that name, see InternAuthor()
+        self.authors = {}
+
     def dprint(self, s):
         "internal helper for printing debug info"
         if self.debug:
-            print(" # DEBUG: '%s'" % s)
+            print(f" # DEBUG: '{s}'")
 
 
     def GetDiffStats(self, rev, lastRev):
@@ -25,128 +284,124 @@ class BlameStats:
         "  * a dictionary of old filename -> list of tuple (lineNum, numberOfLines). These are the lines\n"
         "    in the old file that were deleted by this commit\n"
         "  * a dictionary of new filename -> number of lines added by the author\n"
-        "  * a dictionary of new filename -> number of lines removed by the author\n"
-        "  * a list of tuples of file renames (oldFilename, newFilename)"
-        ""
+        "  * a dictionary of old filename -> number of lines removed by the author\n"
+        "  * a list of tuples of file renames and copies (oldFilename, newFilename)\n"
+        "or None if the diff couldn't be parsed. "
         "NOTE: this assumes the history is totally flat, and pretends that rev happened directly on top of lastRev"
 
-        if lastRev:
-            cmd = self.git_cmd + ['diff',
-                                  '-C', # find copies
-                                  '-M', # find moves
-                                  '-U0', # don't print extra lines around diff
-                                  '-w', # ignore whitespace
-                                  '--no-color',
-                                  lastRev,
-                                  rev]
-        else:
-            cmd = self.git_cmd + ['show', # display commit message and diff
-                                  '-C', # find copies
-                                  '-M', # find moves
-                                  '-w', # ignore whitespace
-                                  '-U0', # don't print extra lines around diff
-                                  '--ignore-submodules',
-                                  '--no-color',
-                                  rev]
-
-        oldLinesPerFile = {}
-        numNewLinesPerFile = {} # key is new file
-        numDeletedLinesPerFile = {} # key is new file
+        fileDiffs = self.GetDiffHunks(rev, lastRev)
+        if fileDiffs is None:
+            return None
+
+        oldLinesPerFile = defaultdict(list) # key is old file
+        numNewLinesPerFile = defaultdict(int) # key is new file
+        numDeletedLinesPerFile = defaultdict(int) # key is old file
         renames = []
 
-        # current parsing state. TODO: enum?
-        state_diff_start = 0
-        state_diff_header = 1
-        state_diff_body = 2
+        for oldFile, newFile, isCopy, hunks in fileDiffs:
+            if oldFile and newFile and oldFile != newFile:
+                renames.append( (oldFile, newFile) )
 
-        state = state_diff_start
+            for oldStart, oldNum, newNum in hunks:
+                if oldNum > 0:
+                    oldLinesPerFile[oldFile].append( (oldStart, oldNum) )
+                    numDeletedLinesPerFile[oldFile] += oldNum
+                if newNum > 0:
+                    numNewLinesPerFile[newFile] += newNum
 
-        oldFile = None
-        newFile = None
+        return (oldLinesPerFile, numNewLinesPerFile, numDeletedLinesPerFile, renames)
 
-        data = subprocess.check_output(cmd)
-        for line in data.split('\n'):
-            if self.debug:
-                print line
 
-            if len(line)>0:
-                if line[:4] == "diff":
-                    oldFile = None
-                    newFile = None
-                    state = state_diff_header
-                    continue
+    def GetDiffHunks(self, rev, lastRev = None):
+        "return the list described in ParseDiffHunks for the diff from lastRev (or the parent) to rev. Raises"
+        " ValueError if either one isn't a commit"
 
-                if line[:2] == '@@':
-                    state = state_diff_body
-
-                if state == state_diff_header:
-                    if line[:3] == '---':
-                        if line[:14] != "--- /dev/null":
-                            oldFile = line[6:]
-                            self.dprint(" old file is %s" % oldFile)
-                            continue
-                    elif line[:3] == '+++':
-                        if line[:14] != "+++ /dev/null":
-                            newFile = line[6:]
-                            self.dprint(" new file is %s" % newFile)
-                            # this comes second
-                            if oldFile and oldFile != newFile:
-                                renames.append( (oldFile, newFile) )
-                            continue
-
-                elif state == state_diff_body:
-                    if line[:3] == '@@@':
-                        self.dprint('merge commit! shouldnt happen, returning empty')
-                        return ({}, {}, {}, [])
-
-                    elif line[:2] == '@@':
-                        # find ending @@
-                        endIdx = line.find('@@', 3)
-                        if endIdx > 2:
-                            for lineChunk in line[3:endIdx-1].split(' '):
-                                commaIdx = lineChunk.find(',')
-                                if commaIdx >= 0:
-                                    try:
-                                        newLineInfo = (int(lineChunk[1:commaIdx]), int(lineChunk[commaIdx+1:]))
-                                    except ValueError:
-                                        print("ERROR: value error! couldn't parse '%s, %s' from line %s" % (
-                                            lineChunk[1:commaIdx],
-                                            lineChunk[commaIdx+1:],
-                                            line) )
-                                        return None
-                                else:
-                                    try:
-                                        # if there's one line, no comma is printed
-                                        newLineInfo = (int(lineChunk[1:]), 1)
-                                    except ValueError:
-                                        print("ERROR: value error! couldn't parse '%s' from line '%s'" % (
-                                            lineChunk[1:],
-                                            line))
-                                        return None
-
-
-                                if newLineInfo[1] > 0:
-                                    if lineChunk[0] == '-':
-                                        if oldFile not in oldLinesPerFile:
-                                            oldLinesPerFile[oldFile] = []
-                                        oldLinesPerFile[oldFile].append(newLineInfo)
-                                        self.dprint("oldLines (%d, %d)" % (newLineInfo[0], newLineInfo[1]))
-
-                    # these are at the bottom ebecause they could fuck up with '---' or '+++'
-                    elif line[0] == '+':
-                        self.dprint("line added")
-                        nc = 0
-                        if newFile in numNewLinesPerFile:
-                            nc = numNewLinesPerFile[newFile]
-                        numNewLinesPerFile[newFile] = nc + 1
-                    elif line[0] == '-':
-                        self.dprint("line removed")
-                        dc = 0
-                        if oldFile in numDeletedLinesPerFile:
-                            dc = numDeletedLinesPerFile[oldFile]
-                        numDeletedLinesPerFile[oldFile] = dc + 1
+        # diff-tree --stdin only understands full shas, so resolve names like HEAD or a short sha first
+        gitWorker = self.GetGitWorker()
+        rev = gitWorker.GetSha(rev)
+        if lastRev:
+            lastRev = gitWorker.GetSha(lastRev)
 
-        return (oldLinesPerFile, numNewLinesPerFile, numDeletedLinesPerFile, renames)
+        diffWorker = self.GetDiffWorker()
+        try:
+            return self.ParseDiffHunks(diffWorker.GetDiffLines(rev, lastRev))
+        finally:
+            # if git exited, start a new one next time instead of writing to the dead pipe
+            if diffWorker.proc.poll() is not None:
+                self.diffWorker = None
+
+
+    def ParseDiffHunks(self, lines):
+        "given the output lines of a git diff with -U0, return a list with a tuple for each file of:\n"
+        "  (old filename, new filename, is copy, list of (old start line, old num lines, new num lines))\n"
+        "The old filename is None for added files, and the new filename is None for deleted files. Returns"
+        " None if a hunk header couldn't be parsed, and an empty list for merge commits"
+
+        files = []
+        current = None
+        inHeader = False
+
+        # local names for everything used on each line, to skip the attribute and global lookups
+        DIFF = _DIFF
+        HUNK = _HUNK
+        MERGE_HUNK = _MERGE_HUNK
+        OLD_FILE = _OLD_FILE
+        NEW_FILE = _NEW_FILE
+        OLD_NULL = _OLD_NULL
+        NEW_NULL = _NEW_NULL
+        matchHunk = _HUNK_RE.match
+
+        # print the input from outside the loop, so the loop itself doesn't check for debug on every line
+        if self.debug:
+            lines = _EchoLines(lines)
+
+        for line in lines:
+            # dispatch on the first character, so most lines only need one comparison
+            c = line[:1]
+
+            if c == 'd':
+                if line[:4] == DIFF:
+                    # [old filename, new filename, is copy, hunks]
+                    current = [None, None, False, []]
+                    files.append(current)
+                    inHeader = True
+
+            elif c == '@':
+                if line[:3] == MERGE_HUNK:
+                    self.dprint('merge commit! shouldnt happen, returning empty')
+                    return []
+
+                if line[:2] != HUNK:
+                    continue
+                inHeader = False
+
+                m = matchHunk(line)
+                if m is None:
+                    print(f"ERROR: couldn't parse hunk header '{line}'")
+                    return None
+                oldStart, oldNum, newStart, newNum = m.groups('1')
+                current[3].append( (int(oldStart), int(oldNum), int(newNum)) )
+
+            elif inHeader:
+                # renames and copies with no changes have no ---/+++ lines, so get the names from these as well.
+                # The ---/+++ names start with a/ or b/, which is inside the quotes for quoted names
+                if line[:3] == OLD_FILE:
+                    if line != OLD_NULL:
+                        current[0] = _DiffPath(line[4:])[2:]
+                elif line[:3] == NEW_FILE:
+                    if line != NEW_NULL:
+                        current[1] = _DiffPath(line[4:])[2:]
+                elif line[:12] == _RENAME_FROM:
+                    current[0] = _DiffPath(line[12:])
+                elif line[:10] == _RENAME_TO:
+                    current[1] = _DiffPath(line[10:])
+                elif line[:10] == _COPY_FROM:
+                    current[0] = _DiffPath(line[10:])
+                    current[2] = True
+                elif line[:8] == _COPY_TO:
+                    current[1] = _DiffPath(line[8:])
+
+        return [tuple(f) for f in files]
 
 
     def GetOldBlameStats(self, rev, lastRev, oldLinesPerFile):
@@ -156,156 +411,295 @@ class BlameStats:
         if lastRev == None:
             return {}
 
-        blame_cmd = self.git_cmd + ['blame',
-                                    '-w', # ignore whitespace
-                                    '-C', # find copies
-                                    '-M', # find moves
-                                    '--line-porcelain' # print info for each line
-                                   ]
+        # no -C or -M here. Copy and move detection is most of the cost of blame, and renames of whole files are
+        # already handled by the diff. The trade off is that lines which were moved or copied into the file
+        # count against whoever moved them, rather than whoever originally wrote them
+        blame_opts = ['-w', # ignore whitespace
+                      '--incremental' # print info once per group of lines
+                     ]
 
-        linesLost = {}
+        blame_cmd = self.git_cmd + ['blame'] + blame_opts
 
-        for filename in oldLinesPerFile:
-            self.dprint("getting stats for '%s'" % filename)
-            linesLost[filename] = []
+        # filename -> -L ranges to blame
+        ranges = {}
+        entries = []
 
-            cmd = blame_cmd + \
-                  [ "-L %d,+%d"% (startLine, numLines) for startLine, numLines in oldLinesPerFile[filename]] + \
-                  [lastRev, '--', filename]
+        for filename in oldLinesPerFile:
+            ranges[filename] = [ f"-L {startLine},+{numLines}" for startLine, numLines in _CoalesceRanges(oldLinesPerFile[filename])]
 
-            linesLostPerAuthor = {}
+            # blame of the same lines at the same commit never changes, so the ranges are part of the cache key
+            entries.append( (filename, ' '.join(blame_opts + ranges[filename])) )
 
-            self.dprint(" ".join(cmd))
-            for line in subprocess.check_output(cmd).split('\n'):
-                if line[:7] == "author ":
-                    author = line[7:]
-                    self.dprint("%s lost a line" % author)
-                    ac = 0
-                    if author in linesLostPerAuthor:
-                        ac = linesLostPerAuthor[author]
-                    linesLostPerAuthor[author] = ac + 1
+        def BlameRanges(filename):
+            self.dprint(f"getting stats for '{filename}'")
+            return self.RunBlame(blame_cmd + ranges[filename] + [lastRev, '--', filename])
 
-            for author in linesLostPerAuthor:
-                linesLost[filename].append( (author, linesLostPerAuthor[author]) )
+        linesLost = {}
+        for filename, linesLostPerAuthor in self.BlameFiles(lastRev, entries, BlameRanges).items():
+            linesLost[filename] = [ (author, linesLostPerAuthor[author]) for author in linesLostPerAuthor ]
 
         return linesLost
 
 
-    def GetCommitAuthor(self, rev):
-        "return the author of the commit specified by rev"
-        
-        cmd = self.git_cmd + ['log',
-                              '-n', '1', # only show one enry
-                              '--format=%aN', # just print author name
-                              rev]
-        revAuthor = subprocess.check_output(cmd)
-        if revAuthor[-1] == '\n':
-            revAuthor = revAuthor[:-1]
+    def BlameFiles(self, rev, entries, blameFunc, largestFirst = False):
+        "shared by GetFullBlames and GetOldBlameStats. entries is a list of (filename, cache options) to blame at"
+        " rev, and blameFunc(filename) runs git blame on one of them, returning a dict of sha -> num_lines or None"
+        " if git failed. Files in the cache are read from there, and the rest are blamed on the thread pool."
+        " Returns a dict of filename -> author -> num_lines, leaving out the files git failed on"
+
+        ret = {}
+
+        if self.cache:
+            # the cache needs the real sha, not something like HEAD
+            sha = self.GetGitWorker().GetSha(rev)
+            newEntries = []
+
+        toBlame = []
+
+        for filename, options in entries:
+            if self.cache:
+                cached = self.cache.Get(self.repo, sha, filename, options)
+                if cached is not None:
+                    ret[filename] = self.GetAuthorLines(cached)
+                    continue
+
+            toBlame.append( (filename, options) )
+
+        def Blame(entry):
+            return (entry, blameFunc(entry[0]))
+
+        # each blame is a separate git process, so run several at once
+        if self.num_threads > 1 and len(toBlame) > 1:
+            # start the biggest files first, so one large file blamed at the end doesn't leave the other threads
+            # sitting idle while it finishes. With no more files than threads they all start at once anyway
+            if largestFirst and len(toBlame) > self.num_threads:
+                sizes = self.GetFileSizes(rev, [filename for filename, options in toBlame])
+                toBlame.sort(key=lambda entry: sizes.get(entry[0], 0), reverse=True)
+            pool = self.GetThreadPool()
+            results = ( future.result() for future in as_completed([ pool.submit(Blame, entry) for entry in toBlame ]) )
+        else:
+            results = (Blame(entry) for entry in toBlame)
+
+        for (filename, options), linesPerSha in results:
+            if linesPerSha is None:
+                continue
+
+            ret[filename] = self.GetAuthorLines(linesPerSha)
+
+            if self.cache:
+                newEntries.append( (self.repo, sha, filename, options, linesPerSha) )
+
+        if self.cache and newEntries:
+            self.cache.PutMany(newEntries)
+
+        return ret
+
+
+    def RunBlame(self, cmd):
+        "run a 'git blame --incremental' command and return a dict of sha -> num_lines. Raises"
+        " subprocess.CalledProcessError if git fails"
+
+        self.dprint(" ".join(cmd))
+
+        # with --incremental the output is small, so read it in one go and split it once, which is cheaper than
+        # reading it a line at a time
+        data = _Text(subprocess.check_output(cmd))
+        return self.CountBlameLines(data.split('\n'))
+
+
+    def CountBlameLines(self, lines):
+        "given the output lines of 'git blame --incremental', return a dict of sha -> num_lines. See"
+        " GetAuthorLines to turn that into authors"
 
-        self.dprint("author of revision is '%s'" % revAuthor)
+        linesPerSha = defaultdict(int)
 
-        return revAuthor
+        # local names for everything used on each line, to skip the attribute and global lookups
+        FILENAME = _FILENAME
 
+        newGroup = True
+
+        for line in lines:
+            if newGroup:
+                if not line:
+                    # the end of the output
+                    continue
+
+                # each group starts with "<sha> <source line> <result line> <num lines>"
+                sha = line[:line.find(' ')]
+                linesPerSha[sha] += int(line[line.rfind(' ')+1:])
+                newGroup = False
+                continue
+
+            # the filename line ends the group. Most header lines don't start with 'f', so check that first
+            if line[:1] == 'f' and line[:9] == FILENAME:
+                newGroup = True
+
+        return dict(linesPerSha)
+
+
+    def GetAuthorLines(self, linesPerSha):
+        "given a dict of sha -> num_lines, return a dict of author -> num_lines. The author is looked up from the"
+        " commit rather than taken from the blame output, since blame applies whatever .mailmap is checked out"
+        " at the time, which would go stale in the cache. This reads commits through the git worker, so don't call"
+        " it from the thread pool"
+
+        linesPerAuthor = defaultdict(int)
+        for sha in linesPerSha:
+            author = self.GetCommit(sha)[2]
+            self.dprint(f"{author} has {linesPerSha[sha]} lines")
+            linesPerAuthor[author] += linesPerSha[sha]
+
+        return dict(linesPerAuthor)
+
+
+    def InternAuthor(self, author):
+        "return a shared string equal to author. Every blame and commit re-parses the same few names, so"
+        " sharing one object per name saves memory and makes dict lookups compare by identity"
+        return self.authors.setdefault(author, author)
+
+
+    def GetGitWorker(self):
+        "return the persistent git process used to read commits, starting it if needed"
+        if self.worker is None:
+            self.worker = _GitWorker(self.git_cmd)
+        return self.worker
+
+    def GetDiffWorker(self):
+        "return the persistent git process used to diff commits, starting it if needed"
+        if self.diffWorker is None:
+            self.diffWorker = _GitDiffWorker(self.git_cmd)
+        return self.diffWorker
+
+    def GetThreadPool(self):
+        "return the pool of threads used to run git blame, starting it if needed"
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.num_threads)
+        return self.pool
+
+    def Close(self):
+        "stop any long-running git processes and threads"
+        if self.worker is not None:
+            self.worker.Close()
+            self.worker = None
+        if self.diffWorker is not None:
+            self.diffWorker.Close()
+            self.diffWorker = None
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def GetCommit(self, rev):
+        "returns a tuple of (list of parents, timestamp, author name) for the given commit. Commits never"
+        " change, so each one is only read from git once. Raises ValueError if rev isn't a commit"
+
+        if rev not in self.commits:
+            parents, ts, author = self.GetGitWorker().GetCommit(rev)
+            self.commits[rev] = (parents, ts, self.InternAuthor(author))
+
+        return self.commits[rev]
 
     def GetParents(self, rev):
         "returns a list of parents of rev. Maybe contain 0, 1, or 2 results"
         
-        cmd = self.git_cmd + ['log',
-                              '-n', '1', # only one entry
-                              '--pretty=format:%P', # just show parents
-                              rev]
-
-        data = subprocess.check_output(cmd)
-        return data.split(' ')
+        return self.GetCommit(rev)[0]
 
 
     def GetFullBlames(self, rev, filenames):
         "given a current revision and a list of filenames, return"
         "a dict of filename -> author -> num_lines"
 
-        blame_cmd = self.git_cmd + ['blame',
-                                    '-w', # ignore whitespace
-                                    '-C', # find copies
-                                    '-M', # find moves
-                                    '--line-porcelain', # print info for each line
-                                    rev
-                                   ]
+        blame_opts = ['-w', # ignore whitespace
+                      '-C', # find copies
+                      '-M', # find moves
+                      '--incremental' # print info once per group of lines
+                     ]
 
-        ret = {}
-
-        for filename in filenames:
-            cmd = blame_cmd + ['--', filename]
-            self.dprint(" ".join(cmd))
+        blame_cmd = self.git_cmd + ['blame'] + blame_opts + [rev]
+        options = ' '.join(blame_opts)
 
+        def BlameFile(filename):
             try:
-                data = subprocess.check_output(cmd)
+                return self.RunBlame(blame_cmd + ['--', filename])
             except subprocess.CalledProcessError as cpe:
-                print "Warning: git failed"
-                print cpe
-                print "continuing anyway..."
-                continue
+                print("Warning: git failed")
+                print(cpe)
+                print("continuing anyway...")
+                return None
 
-            ret[filename] = {}
+        return self.BlameFiles(rev, [ (filename, options) for filename in filenames ], BlameFile, largestFirst=True)
 
-            for line in data.split('\n'):
-                if line[:7] == "author ":
-                    author = line[7:]
-                    ac = 0
-                    if author in ret[filename]:
-                        ac = ret[filename][author]
-                    ret[filename][author] = ac + 1
+    def GetFileSizes(self, rev, filenames):
+        "return a dict of filename -> size in bytes for each of filenames in the tree at rev. Only the given"
+        " files are looked up, so this costs the same in a large repository as in a small one"
 
-        return ret
+        # the filenames aren't patterns. Each ls-tree only gets so many of them, to stay under the limit on the
+        # length of a command line
+        cmd = self.git_cmd + ['--literal-pathspecs', 'ls-tree', '-r', '-l', '-z', rev, '--']
+        chunkSize = 1000
+
+        sizes = {}
+        for i in range(0, len(filenames), chunkSize):
+            self.dprint(" ".join(cmd) + f" ({len(filenames[i:i+chunkSize])} files)")
+
+            data = _Text(subprocess.check_output(cmd + filenames[i:i+chunkSize]))
+            for entry in data.split('\0'):
+                if not entry:
+                    continue
+                info, filename = entry.split('\t', 1)
+                size = info.split()[3]
+                # submodules have no size
+                if size != '-':
+                    sizes[filename] = int(size)
+
+        return sizes
 
     def GetFilesTouchedByCommit(self, rev):
         "returns a tuple of:"
         " * a list of filenames that exist in rev that have changes"
         " * a list of filenames that rev deleted"
 
-        cmd = self.git_cmd + ['show', # display commit message and diff
+        cmd = self.git_cmd + ['diff-tree',
+                              '-r', # recurse into directories
                               '-M', # find moves
-                              '--no-color',
+                              '--name-status', # just one status and filename(s) per file, no patch
+                              '--no-commit-id',
+                              '--root', # show the initial commit as adding everything
+                              '--cc', # for merges, only show files that differ from all parents
                               '--ignore-submodules',
+                              '-z', # NUL terminated and unquoted filenames
                               rev]
 
-        oldFile = None
-        newFile = None
-        header = False
-
         files = []
         deletedFiles = []
 
-        renamed_from = 'rename from '
-        renamed_to = 'rename to '
-
         self.dprint(' '.join(cmd))
 
-        data = subprocess.check_output(cmd)
-        for line in data.split('\n'):
-            if len(line)>0:
-                if line[:4] == "diff":
-                    header = True
-                    oldFile = None
-                    newFile = None
-                if line[:2] == '@@':
-                    header = False
-
-                if header:
-                    if line[:3] == '---':
-                        if line[:14] != "--- /dev/null":
-                            oldFile = line[6:]
-                            continue
-                    elif line[:3] == '+++':
-                        if line[:14] != "+++ /dev/null":
-                            newFile = line[6:]
-                            files.append(newFile.strip())
-                        else:
-                            deletedFiles.append(oldFile.strip())
-
-                    elif line[:len(renamed_from)] == renamed_from:
-                        deletedFiles.append(line[len(renamed_from):])
-                    elif line[:len(renamed_to)] == renamed_to:
-                        files.append(line[len(renamed_to):])
+        # each entry is the status followed by the filename, e.g. "M\0file\0". Renames and copies have a
+        # similarity score and two filenames, e.g. "R100\0old\0new\0". Merges have one status letter per
+        # parent, e.g. "MM\0file\0"
+        fields = _Text(subprocess.check_output(cmd)).split('\0')
+
+        i = 0
+        while i + 1 < len(fields):
+            status = fields[i]
+
+            if status[:1] in ('R', 'C') and status[1:].isdigit():
+                oldFile = fields[i+1]
+                newFile = fields[i+2]
+                i += 3
+
+                files.append(newFile)
+                if status[0] == 'R':
+                    deletedFiles.append(oldFile)
+            else:
+                filename = fields[i+1]
+                i += 2
+
+                # 'D' for any parent means the file isn't in rev
+                if 'D' in status:
+                    deletedFiles.append(filename)
+                else:
+                    files.append(filename)
 
         return files, deletedFiles
 
@@ -319,67 +713,94 @@ class BlameStats:
 
         newFiles, deletedFiles = self.GetFilesTouchedByCommit(rev)
 
-        self.dprint("new files: %s" % newFiles)
+        self.dprint(f"new files: {newFiles}")
 
         blames = self.GetFullBlames(rev, newFiles)
 
         for filename in deletedFiles:
             if filename in blames:
-                print "ERROR: file '%s' was deleted but also edited" % filename
+                print(f"ERROR: file '{filename}' was deleted but also edited")
             blames[filename] = {}
 
         return blames
 
 
-    def GetCommitStats_broken(self, rev, lastRev):
+    def UpdateBlames(self, blames, rev):
+        "given blames as a dict of filename -> author -> num_lines for the commit before rev, update it in"
+        " place to match rev. Only the files touched by rev get blamed again, everything else is carried"
+        " over from the previous commit. Deleted files are removed"
+
+        newStats = self.GetCommitStats(rev)
+
+        for filename in newStats:
+            if newStats[filename]:
+                blames[filename] = newStats[filename]
+            elif filename in blames:
+                del blames[filename]
+
+
+    def GetCommitStats_broken(self, rev, lastRev, state = None):
         "take a given revision and return a dictionary of:\n"
         "    new filename -> author -> (lines added, lines removed)"
         "lastRev should be the immediately proceeding commit to rev"
-        " THIS IS BROKEN! only works for repos with no merges"
-        
+        " THIS IS BROKEN! only works for repos with no merges."
+        " If state is a BlameState holding the blame at lastRev, the lines removed are looked up in it (and it"
+        " is moved on to rev) instead of running git blame, so it must be passed every commit in order"
 
-        oldLinesPerFile, numNewLinesPerFile, numDeletedLinesPerFile, renames = self.GetDiffStats(rev, lastRev)
+        revAuthor = self.GetCommitProperties(rev)[1]
+        self.dprint(f"author of revision is '{revAuthor}'")
 
-        if self.debug:
-            pprint(oldLinesPerFile)
-            pprint(numNewLinesPerFile)
-            pprint(numDeletedLinesPerFile)
-            pprint(renames)
+        if state is not None:
+            # one pass over the diff gives both the lines added and who owned the lines removed
+            fileDiffs = self.GetDiffHunks(rev, lastRev)
 
-        linesLost = self.GetOldBlameStats(rev, lastRev, oldLinesPerFile)
+            numNewLinesPerFile = defaultdict(int)
+            for oldFile, newFile, isCopy, hunks in fileDiffs:
+                for oldStart, oldNum, newNum in hunks:
+                    if newNum > 0:
+                        numNewLinesPerFile[newFile] += newNum
 
-        if self.debug:
-            pprint(linesLost)
+            linesLost = state.ApplyDiff(revAuthor, fileDiffs)
 
-        for filename in numDeletedLinesPerFile:
-            total1 = numDeletedLinesPerFile[filename]
-            if filename in linesLost:
-                total2 = sum([num for auth,num in linesLost[filename]])
-                if total1 != total2:
-                    print "ERROR: number of blame lines and deleted lines differs for commit '%s'" % rev
+            if self.debug:
+                pprint(fileDiffs)
+                pprint(linesLost)
 
-        ret = {}
+        else:
+            oldLinesPerFile, numNewLinesPerFile, numDeletedLinesPerFile, renames = self.GetDiffStats(rev, lastRev)
+
+            if self.debug:
+                pprint(oldLinesPerFile)
+                pprint(numNewLinesPerFile)
+                pprint(numDeletedLinesPerFile)
+                pprint(renames)
+
+            linesLost = self.GetOldBlameStats(rev, lastRev, oldLinesPerFile)
+
+            if self.debug:
+                pprint(linesLost)
 
-        revAuthor = self.GetCommitAuthor(rev)
+            for filename in numDeletedLinesPerFile:
+                total1 = numDeletedLinesPerFile[filename]
+                if filename in linesLost:
+                    total2 = sum([num for auth,num in linesLost[filename]])
+                    if total1 != total2:
+                        print(f"ERROR: number of blame lines and deleted lines differs for commit '{rev}'")
+
+        ret = {}
 
         # first add the lines that were deleted
         for filename in linesLost:
             ret[filename] = {}
 
-            if filename in linesLost:
-                for author, lines in linesLost[filename]:
-                    self.dprint("    -= %d to '%s'" % (lines, author))
-                    ret[filename][author] = (0, lines)
+            for author, lines in linesLost[filename]:
+                self.dprint(f"    -= {lines} to '{author}'")
+                ret[filename][author] = (0, lines)
 
-        # now add lines added by us for each filename
+        # now add lines added by us for each filename, keeping any lines we removed from ourselves
         for filename in numNewLinesPerFile:
-            if filename not in ret:
-                ret[filename] = {}
-
-            if revAuthor not in ret[filename]:
-                ret[filename][revAuthor] = (numNewLinesPerFile[filename], 0)
-            else:
-                ret[filename][revAuthor] = (numNewLinesPerFile[filename], ret[filename][revAuthor][1])
+            fileStats = ret.setdefault(filename, {})
+            fileStats[revAuthor] = (numNewLinesPerFile[filename], fileStats.get(revAuthor, (0, 0))[1])
 
         return ret
 
@@ -388,36 +809,36 @@ class BlameStats:
         return self.git_cmd
 
     def GetAllCommits(self, since = None, limit = None):
-        "return the revision list, since the commit 'since'. Optionally limit the number of commits"
+        "return the revision list, since the commit 'since'. Optionally limit the number of commits."
+        " Also remembers the parents, timestamp and author of each one, so GetParents and GetCommitProperties"
+        " don't need git"
 
-        cmd = self.git_cmd + ['rev-list', '--reverse', '--topo-order', 'HEAD']
+        cmd = self.git_cmd + ['log', '--reverse', '--topo-order', '--format=%H%x00%P%x00%at%x00%aN', 'HEAD']
         if since:
             cmd = cmd + ['^' + since]
         if limit:
-            cmd = cmd + ['-n', '%d' % limit]
-        revs = subprocess.check_output(cmd).split('\n')
+            cmd = cmd + ['-n', str(limit)]
+        # build the list straight from git's output instead of splitting one big string first
+        revs = []
+        for line in _GitLines(cmd):
+            fields = line.split('\0')
+            # only keep things long enough to be commits
+            if len(fields) == 4 and len(fields[0]) > 8:
+                rev = fields[0]
+                revs.append(rev)
+                self.commits[rev] = (fields[1].split(), int(fields[2]), self.InternAuthor(fields[3]))
 
-        # only return things long enough to be commits
-        return [r for r in revs if len(r) > 8]
+        return revs
 
 
     def GetCommitProperties(self, rev):
         "returns a tuple of (timestamp, author name) for the given commit"
-        
-        cmd = self.git_cmd + ['log',
-                              rev,
-                              '-n', '1',
-                              '--pretty=format:%at %aN']
-
-        response = subprocess.check_output(cmd)
-        spaceIdx = response.find(' ')
-        if spaceIdx > 0:
-            try:
-                ts = int(response[:spaceIdx])
-                author = response[spaceIdx+1:]
-                return (ts, author)
-            except ValueError:
-                print "ERROR: could not convert log response '%s'" % response
+
+        try:
+            parents, ts, author = self.GetCommit(rev)
+            return (ts, author)
+        except ValueError as e:
+            print(f"ERROR: could not read commit: {e}")
 
         return (0, '')
 
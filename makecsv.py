@@ -55,11 +55,12 @@ dates = []
 
 
 with sqlite3.connect(db_filename) as conn:
-    blames = query.GetFullBlameOverTime(conn.cursor(), exclusions, nameMap)
+    # rows are written out as they are generated, rather than building all of them first
+    blames = query.IterFullBlameOverTime(conn.cursor(), exclusions, nameMap)
 
     authors = query.GetAllAuthors(conn.cursor(), nameMap)
 
-    print authors
+    print(authors)
 
     authorToIndex = {}
 
@@ -77,7 +78,7 @@ with sqlite3.connect(db_filename) as conn:
         outfile.write(header + '\n')
 
         for line in blames:
-            # print line
+            # print(line)
             ts = line[0]
             repo = line[1]
             commit = line[2]
@@ -97,7 +98,7 @@ with sqlite3.connect(db_filename) as conn:
 
     # for i in range(1, len(dates)):
     #     if dates[i] < dates[i-1]:
-    #         print "uh oh! %d: %d < %d" % (i, dates[i], dates[i-1])
+    #         print(f"uh oh! {i}: {dates[i]} < {dates[i-1]}")
 
     # plt.plot(range(len(dates)), dates)
     # plt.show()
@@ -58,7 +58,7 @@ Y = None
 
 with sqlite3.connect(db_filename) as conn:
     # authors = query.GetAllAuthors(conn.cursor(), nameMap)
-    # print authors
+    # print(authors)
 
     blames = query.GetFullBlameOverTime(conn.cursor(), exclusions, nameMap)
 
@@ -66,7 +66,7 @@ with sqlite3.connect(db_filename) as conn:
     authors2 = []
     for author in blames[-1][3]:
         authors2.append( (author, blames[-1][3][author]) )
-    authors2.sort( lambda x,y : -1 if x[1] > y[1] else 1 )
+    authors2.sort(key=lambda x: x[1], reverse=True)
 
     authors = [x[0] for x in authors2]
 
@@ -82,7 +82,7 @@ with sqlite3.connect(db_filename) as conn:
         num_cols += 1
 
     Y = np.zeros( (len(blames), len(authors)) )
-    print Y.shape
+    print(Y.shape)
 
     for rowIdx in range(len(blames)):
         line = blames[rowIdx]
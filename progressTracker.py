@@ -102,7 +102,7 @@ class ProgressTracker:
         elapsed = time.time() - self.start_time
 
         if elapsed > self.time_delay:
-            return "Completed in %s" % str(datetime.timedelta(seconds = elapsed))
+            return f"Completed in {datetime.timedelta(seconds = elapsed)}"
         else:
             return ''
 
@@ -3,6 +3,7 @@
 # this is just some code to test the blame stuff
 
 from gitBlameStats import *
+from blameState import BlameState, BlameStateStore
 
 repo_path = "/Users/bneuman/Documents/code/bvv4"
 
@@ -15,39 +16,66 @@ limit = 10 #None
 
 from pprint import pprint
 
-bs = BlameStats(repo_path, debug = True)
-
-pprint(bs.GetCommitStats(rev))
-exit(0)
-
-# for rev in bs.GetAllCommits():
-#     print rev, bs.GetFilesTouchedByCommit(rev)
-# exit(0)
-
 # utility functions for dealing with multiple results
 def CombineStats(lhs, rhs):
     "combine the two sets of commit stats, store into lhs"
-    for filename in rhs:
-        lhs[filename] = rhs[filename]
+    # each commit has the full blame of the files it touched, so newer entries just replace older ones
+    lhs.update(rhs)
 
 def SquashBlame(stats):
-    "return a new dict from stats with a single total line number, and no entry if it would be 0"
-    return stats
+    "return a new dict from stats without authors that have 0 lines, or files with no authors (i.e. deleted)"
     ret = {}
-    for filename in stats:
-        for author in stats[filename]:
-            tpl = stats[filename][author]
-            if tpl[0] != tpl[1]:
-                # add it
-                if filename not in ret:
-                    ret[filename] = {}
-                ret[filename][author] = tpl[0] - tpl[1]
+    for filename, blame in stats.items():
+        squashed = dict( (author, lines) for author, lines in blame.items() if lines )
+        if squashed:
+            ret[filename] = squashed
 
     return ret
 
-def blameTester(limit = None):
+def _InitWorker():
+    "runs once in each pool process. Each one needs its own git processes, rather than the parent's pipes"
+    global bs
+    # the parallelism is across commits, so don't also start a thread pool per process
+    bs = BlameStats(repo_path, num_threads = 1)
+
+def _GetCommitStats(rev):
+    return (rev, bs.GetCommitStats(rev))
+
+def blameTester(limit = None, checkpoints = None):
     "simulates doing a git blame on all current files, but using the commit by commit"
-    "machinery here. NOTE: this only works if there are no merges in the history"
+    "machinery here. NOTE: this only works if there are no merges in the history."
+    " If checkpoints (a BlameStateStore) is given, start from the last saved state and save the new one"
+
+    # keep the author of every line in memory and update it from each diff, instead of running git blame.
+    # This starts from an empty tree, so with a limit, lines from before the first commit are missing
+    state = BlameState()
+    since = None
+
+    if checkpoints:
+        saved = checkpoints.Load(repo_path)
+        if saved:
+            since, state = saved
+            print(f"resuming from {since}")
+
+    revs = bs.GetAllCommits(since=since, limit=limit)
+
+    from progressTracker import ProgressTracker
+    pt = ProgressTracker(len(revs))
+
+    for rev in revs:
+        pt.Update()
+        print(rev, pt)
+        state.ApplyDiff(bs.GetCommitProperties(rev)[1], bs.GetDiffHunks(rev))
+
+    # with a limit the state is missing everything from before the first commit, so don't keep it
+    if checkpoints and revs and limit is None:
+        checkpoints.Save(repo_path, revs[-1], state)
+
+    return state.GetBlames()
+
+def fullBlameTester(limit = None):
+    "same as blameTester, but runs git blame on every file touched by each commit. Much slower, but"
+    " useful to check blameTester against"
 
     revs = bs.GetAllCommits(limit=limit)
 
@@ -56,31 +84,45 @@ def blameTester(limit = None):
     from progressTracker import ProgressTracker
     pt = ProgressTracker(len(revs))
 
-    for i in range(len(revs)):
-        rev = revs[i]
-        lastRev = None
-        if i > 0:
-            lastRev = revs[i-1]
+    # commits don't depend on each other, so blame them in parallel. imap keeps the results in order, which
+    # matters because CombineStats lets later commits overwrite earlier ones
+    import multiprocessing
+    pool = multiprocessing.Pool(initializer = _InitWorker)
+    chunksize = max(1, len(revs) // (4 * multiprocessing.cpu_count()))
 
+    for rev, stats in pool.imap(_GetCommitStats, revs, chunksize):
         pt.Update()
-        if len(rev) > 8: # sha-1s should be long
-            print rev, pt
-            stats = bs.GetCommitStats(rev)
-            CombineStats(total, stats)
+        print(rev, pt)
+        CombineStats(total, stats)
+
+    pool.close()
+    pool.join()
 
     # remove empty entries (i.e. changes that net to 0)
     return SquashBlame(total)
 
 
-sb = blameTester(limit)
+if __name__ == '__main__':
+    # only when run directly, so the pool processes in blameTester can import this file without redoing it
+    bs = BlameStats(repo_path, debug = True)
+
+    pprint(bs.GetCommitStats(rev))
+    exit(0)
+
+    # for rev in bs.GetAllCommits():
+    #     print(rev, bs.GetFilesTouchedByCommit(rev))
+    # exit(0)
+
+    checkpoints = BlameStateStore('blame_state.db')
+    sb = blameTester(limit, checkpoints)
+    checkpoints.Close()
+
+    from collections import defaultdict
 
-authorCount = {}
+    authorCount = defaultdict(int)
 
-for filename in sb:
-    for author in sb[filename]:
-        ac = 0
-        if author in authorCount:
-            ac = authorCount[author]
-        authorCount[author] = ac + sb[filename][author]
+    for filename in sb:
+        for author in sb[filename]:
+            authorCount[author] += sb[filename][author]
 
-pprint(authorCount)
+    pprint(dict(authorCount))
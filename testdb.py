@@ -15,17 +15,17 @@ def showCurrBlame(conn):
     break_str = format_str % (filenameLength * '-', authorLength * '-', linesLength * '-')
 
 
-    print format_str % ('filename', 'author', 'lines')
-    print break_str
+    print(format_str % ('filename', 'author', 'lines'))
+    print(break_str)
 
     lastFilename = None
 
     for line in blame:
         filename = line[0]
         if filename == lastFilename:
-            print format_str % ('', line[1], line[2])
+            print(format_str % ('', line[1], line[2]))
         else:
-            print format_str % line
+            print(format_str % line)
 
         lastFilename = filename
 
@@ -36,6 +36,7 @@ def blameOverTime(conn):
     pprint.pprint(blame)
 
 
-with sqlite3.connect(db_filename) as conn:
-    # showCurrBlame(conn)
-    blameOverTime(conn)
+if __name__ == '__main__':
+    with sqlite3.connect(db_filename) as conn:
+        # showCurrBlame(conn)
+        blameOverTime(conn)
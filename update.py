@@ -5,6 +5,7 @@
 
 # Requires sqlite3
 
+from blameCache import BlameCache
 from gitBlameStats import *
 from progressTracker import *
 import argparse
@@ -19,6 +20,8 @@ parser.add_argument('--recursive', '-r', help='Also update all submodules',
                     default = False, action='store_true')
 parser.add_argument('--dry-run', '-n', help='Dry-run (just print what would be done, don\'t do it',
                     default = False, action='store_true')
+parser.add_argument('--no-cache', help='Don\'t read or write the on-disk cache of blame results',
+                    default = False, action='store_true')
 parser.add_argument('path', help="path to the repository to update")
 
 args = parser.parse_args()
@@ -26,14 +29,14 @@ args = parser.parse_args()
 repo_paths = set([args.path])
 
 if args.recursive:
-    print 'searching for submodules...'
+    print('searching for submodules...')
 
     def check_modules(repo):
         modfile = os.path.join(repo, '.gitmodules')
         if os.path.isfile( modfile ):
             args = ['git', '--no-pager', 'config',
                     '--file', modfile, '--get-regexp', '.*path']
-            result = subprocess.check_output(args)
+            result = subprocess.check_output(args).decode('utf-8', 'surrogateescape')
             for line in result.split('\n'):
                 s = line.strip().split(' ')
                 if len(s) == 2:
@@ -44,6 +47,11 @@ if args.recursive:
 
 db_filename = 'blame.db'
 schema_filename = 'schema.sql'
+cache_filename = 'blame_cache.db'
+
+cache = None
+if not args.no_cache and not args.dry_run:
+    cache = BlameCache(cache_filename)
 
 db_is_new = not os.path.exists(db_filename)
 
@@ -55,12 +63,12 @@ for repo_path in repo_paths:
         path_split = os.path.split(path_split[0])
     repo_name = path_split[1]
 
-    print "Run update on repository at '%s'" % repo_path
+    print(f"Run update on repository at '{repo_path}'")
 
-    bs = BlameStats(repo_path, debug = False)
+    bs = BlameStats(repo_path, debug = False, cache = cache)
 
     if db_is_new:
-        print 'Creating new blank databse'
+        print('Creating new blank databse')
         if args.dry_run:
             continue
 
@@ -80,11 +88,11 @@ for repo_path in repo_paths:
         lastOrder = int(row[1])
         latestRev = row[0]
 
-    print "lastest revision for '%s' is '%s'" % (repo_name, latestRev)
+    print(f"lastest revision for '{repo_name}' is '{latestRev}'")
 
     revs = bs.GetAllCommits(since=latestRev)
 
-    print 'have %d revisions to update' % len(revs)
+    print(f'have {len(revs)} revisions to update')
 
     if not args.dry_run:
 
@@ -98,9 +106,9 @@ for repo_path in repo_paths:
         for i in range(len(revs)):
             rev = revs[i]
             if len(repo_paths) > 1:
-                print os.path.basename(repo_path), rev, pt.Update()
+                print(os.path.basename(repo_path), rev, pt.Update())
             else:
-                print rev, pt.Update()
+                print(rev, pt.Update())
 
             # first, update the commits table
             commit_ts, commit_author = bs.GetCommitProperties(rev)
@@ -115,36 +123,25 @@ for repo_path in repo_paths:
                 if i > 0:
                     lastRev = revs[i-1]
 
-                # now update the main blames table
-
-                newStats = bs.GetCommitStats(rev)
+                # now update the main blames table. stats holds the blames from the previous commit, so
+                # only the files changed by this one need to be blamed again
 
-                for filename in newStats:
-                    stats[filename] = newStats[filename]
-
-                filenamesToDelete = []
+                bs.UpdateBlames(stats, rev)
 
                 for filename in stats:
-                    if stats[filename]:
-                        for author in stats[filename]:
-                            lines = stats[filename][author]
-                            val = (rev, repo_name, filename, author, lines)
-                            # print "inserting:", val
-                            conn.cursor().execute('insert into full_blames values (?, ?, ?, ?, ?)', val)
-
-        #            else:
-                        # # add a row with 0 lines to show that the file is no longer present, then remove it from stats
-                        # val = (rev, repo_name, filename, '', 0)
-                        # # print "inserting:", val
-                        # cur.execute('insert into full_blames values (?, ?, ?, ?, ?)', val)
-
-                        # filenamesToDelete.append(filename)
-
-                for filename in filenamesToDelete:
-                    del stats[filename]
+                    for author in stats[filename]:
+                        lines = stats[filename][author]
+                        val = (rev, repo_name, filename, author, lines)
+                        # print("inserting:", val)
+                        conn.cursor().execute('insert into full_blames values (?, ?, ?, ?, ?)', val)
 
                 # commit every now and then so we don't lose everything if something goes wrong
                 if i % 20 == 0:
                     conn.commit()
 
-        print pt.Done()
+        print(pt.Done())
+
+    bs.Close()
+
+if cache:
+    cache.Close()